@@ -0,0 +1,73 @@
+"""
+Deduplicate User Emails
+
+The unique email index (created at app startup) cannot be built while the
+"user" collection already holds accounts sharing an email, which the old
+find-then-insert registration could create. Run this once before deploying:
+
+    python dedupe_user_emails.py          # report duplicates only
+    python dedupe_user_emails.py --apply  # delete duplicates that have no orders
+
+For each email the oldest account is kept. Extra accounts that have orders are
+never deleted; they are reported so their orders can be reassigned by hand.
+Deleted accounts can no longer log in with their own password.
+"""
+
+import os
+import sys
+
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+load_dotenv()
+
+# Must match EMAIL_COLLATION in main.py so duplicates are grouped like the index compares them
+EMAIL_COLLATION = {"locale": "en", "strength": 2}
+
+
+def find_duplicates(db):
+    """Yield (email, [ids oldest first]) for every email used by more than one user"""
+    pipeline = [
+        {"$sort": {"_id": 1}},
+        {"$group": {"_id": "$email", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+    for group in db["user"].aggregate(pipeline, collation=EMAIL_COLLATION):
+        yield group["_id"], group["ids"]
+
+
+def main(apply: bool = False):
+    database_url = os.getenv("DATABASE_URL")
+    database_name = os.getenv("DATABASE_NAME")
+    if not (database_url and database_name):
+        sys.exit("DATABASE_URL and DATABASE_NAME must be set")
+
+    db = MongoClient(database_url)[database_name]
+    removed = 0
+    blocked = 0
+    for email, ids in find_duplicates(db):
+        keep, extra = ids[0], ids[1:]
+        print(f"{email}: keeping {keep}")
+        deletable = []
+        for user_id in extra:
+            # Orders reference their user by the string form of _id
+            orders = db["order"].count_documents({"user_id": str(user_id)})
+            print(f"  duplicate {user_id}: {orders} order(s)")
+            if orders:
+                blocked += 1
+            else:
+                deletable.append(user_id)
+        if apply and deletable:
+            removed += db["user"].delete_many({"_id": {"$in": deletable}}).deleted_count
+
+    if apply:
+        print(f"Removed {removed} duplicate user(s)")
+    else:
+        print("Dry run; pass --apply to delete duplicates without orders")
+    if blocked:
+        print(f"{blocked} duplicate user(s) have orders and were left in place; "
+              "move their orders to the kept account and re-run")
+
+
+if __name__ == "__main__":
+    main(apply="--apply" in sys.argv[1:])
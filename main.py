@@ -1,50 +1,100 @@
+import hashlib
+import logging
 import os
-from datetime import datetime, timedelta, timezone
+import threading
+import time
+from datetime import timedelta
 from typing import List, Optional
 
+import bcrypt
+import jwt
+import orjson
 from bson import ObjectId
-from fastapi import Depends, FastAPI, HTTPException, Request
+from cachetools import TTLCache
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from jwt import InvalidTokenError
 from pydantic import BaseModel, EmailStr
-from passlib.context import CryptContext
-from jose import jwt, JWTError
+from pymongo.errors import ConnectionFailure, DuplicateKeyError, OperationFailure, PyMongoError
 
-from database import db, create_document, get_documents
+from database import db, create_document
 from schemas import Shoe, Order
 
-app = FastAPI(title="Formal Shoes Store API")
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="Formal Shoes Store API", default_response_class=ORJSONResponse)
+
+# Comma-separated allowlist, e.g. "https://shop.example.com,http://localhost:3000"
+CORS_ORIGINS = frozenset(
+    o.strip() for o in os.getenv("CORS_ORIGINS", "http://localhost:3000").split(",") if o.strip()
+)
+# With credentials Starlette would echo back any Origin for "*", so a wildcard only gets
+# credential-less CORS (bearer tokens in the Authorization header still work).
+CORS_ALLOW_CREDENTIALS = "*" not in CORS_ORIGINS
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
+    allow_origins=CORS_ORIGINS,
+    allow_credentials=CORS_ALLOW_CREDENTIALS,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,  # let browsers cache preflights for a day
 )
 
 # === Security & Auth Setup ===
 SECRET_KEY = os.getenv("SECRET_KEY", "dev-secret-please-change")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
+ACCESS_TOKEN_EXPIRE_SECONDS = ACCESS_TOKEN_EXPIRE_MINUTES * 60
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "10"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 http_bearer = HTTPBearer(auto_error=False)
 
+# Short-lived cache of verified tokens -> user docs, keyed by a digest of the token
+# so raw tokens never sit in memory. Only successful lookups are cached.
+TOKEN_CACHE_TTL_SECONDS = 5
+_token_cache = TTLCache(maxsize=10_000, ttl=TOKEN_CACHE_TTL_SECONDS)
+_token_cache_lock = threading.Lock()
+
+
+# bcrypt only looks at the first 72 bytes of a password; truncate explicitly like passlib did
+BCRYPT_MAX_PASSWORD_BYTES = 72
+# Every hash made by hash_password starts with this, e.g. "$2b$10$"
+BCRYPT_HASH_PREFIX = f"$2b${BCRYPT_ROUNDS:02d}$"
+
 
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    secret = password.encode("utf-8")[:BCRYPT_MAX_PASSWORD_BYTES]
+    return bcrypt.hashpw(secret, bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode("ascii")
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    secret = plain_password.encode("utf-8")[:BCRYPT_MAX_PASSWORD_BYTES]
+    try:
+        return bcrypt.checkpw(secret, hashed_password.encode("ascii"))
+    except ValueError:
+        # Missing or malformed hash
+        return False
+
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    """True if the hash wasn't made by hash_password with the current BCRYPT_ROUNDS"""
+    return not hashed_password.startswith(BCRYPT_HASH_PREFIX)
+
+
+async def rehash_password(user_id, plain_password: str) -> None:
+    """Re-hash a password at the current cost and store it (run as a background task)"""
+    password_hash = await run_in_threadpool(hash_password, plain_password)
+    await db["user"].update_one({"_id": user_id}, {"$set": {"password_hash": password_hash}})
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
-    to_encode = data.copy()
-    expire = datetime.now(timezone.utc) + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    lifetime = int(expires_delta.total_seconds()) if expires_delta else ACCESS_TOKEN_EXPIRE_SECONDS
+    return jwt.encode({**data, "exp": int(time.time()) + lifetime}, SECRET_KEY, algorithm=ALGORITHM)
 
 
 class Token(BaseModel):
@@ -69,27 +119,67 @@ class UserPublic(BaseModel):
     email: EmailStr
 
 
+# Emails are matched case-insensitively by Mongo (strength 2 ignores case), so queries
+# on "email" must pass this collation to hit the index.
+EMAIL_COLLATION = {"locale": "en", "strength": 2}
+EMAIL_INDEX_NAME = "email_ci_unique"
+
+
 # Helpers
 class ObjectIdStr(BaseModel):
     id: str
 
 
 def to_public(doc: dict):
+    """Rename Mongo's _id to a string id in place (docs are fresh from the driver)"""
     if not doc:
         return doc
-    d = doc.copy()
-    if "_id" in d:
-        d["id"] = str(d.pop("_id"))
-    return d
+    if "_id" in doc:
+        doc["id"] = str(doc.pop("_id"))
+    return doc
+
+
+# Registration relies on the unique email index for duplicate detection, so it is
+# refused until the index is known to exist.
+_email_index_ready = False
+
+
+async def ensure_email_index() -> None:
+    """Build the case-insensitive unique email index (a no-op if it already exists)"""
+    global _email_index_ready
+    await db["user"].create_index(
+        "email", unique=True, collation=EMAIL_COLLATION, name=EMAIL_INDEX_NAME
+    )
+    _email_index_ready = True
+
+
+@app.on_event("startup")
+async def ensure_indexes():
+    if db is None:
+        return
+    # Failures must not stop the API (and /test) from booting; register_user retries.
+    try:
+        await ensure_email_index()
+    except ConnectionFailure as e:
+        logger.warning("Mongo unreachable, email index will be built on first registration: %s", e)
+    except OperationFailure as e:
+        # Usually existing duplicate emails; see dedupe_user_emails.py
+        logger.error("Could not build unique email index, registration disabled: %s", e)
 
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Formal Shoes API running"}
 
 
+# Environment doesn't change at runtime; collection names are only refreshed once a minute
+DATABASE_URL_SET = bool(os.getenv("DATABASE_URL"))
+DATABASE_NAME_SET = bool(os.getenv("DATABASE_NAME"))
+_collections_cache = TTLCache(maxsize=1, ttl=60)
+
+
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -102,11 +192,14 @@ def test_database():
     try:
         if db is not None:
             response["database"] = "✅ Available"
-            response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
-            response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
+            response["database_url"] = "✅ Set" if DATABASE_URL_SET else "❌ Not Set"
+            response["database_name"] = "✅ Set" if DATABASE_NAME_SET else "❌ Not Set"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                await db.command("ping")
+                collections = _collections_cache.get("names")
+                if collections is None:
+                    collections = _collections_cache["names"] = await db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -119,63 +212,92 @@ def test_database():
 
 
 # === Auth Endpoints ===
-@app.post("/auth/register", response_model=UserPublic)
-def register_user(payload: RegisterRequest):
+# Auth/product responses are built from trusted data and returned as ORJSONResponse
+# directly, skipping FastAPI's response-model validation and jsonable_encoder pass.
+# `responses=` keeps the schemas in the OpenAPI docs.
+@app.post("/auth/register", responses={200: {"model": UserPublic}})
+async def register_user(payload: RegisterRequest):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-
-    existing = db["user"].find_one({"email": payload.email.lower()})
-    if existing:
-        raise HTTPException(status_code=400, detail="Email already registered")
+    if not _email_index_ready:
+        try:
+            await ensure_email_index()
+        except PyMongoError as e:
+            logger.error("Unique email index unavailable: %s", e)
+            raise HTTPException(status_code=503, detail="Registration temporarily unavailable")
 
     user_doc = {
         "name": payload.name,
-        "email": payload.email.lower(),
-        "password_hash": hash_password(payload.password),
+        "email": payload.email,
+        "password_hash": await run_in_threadpool(hash_password, payload.password),
     }
-    user_id = create_document("user", user_doc)
-    return UserPublic(id=user_id, name=payload.name, email=payload.email)
+    try:
+        user_id = await create_document("user", user_doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    return ORJSONResponse({"id": user_id, "name": payload.name, "email": payload.email})
 
 
-@app.post("/auth/login", response_model=Token)
-def login_user(payload: LoginRequest):
+@app.post("/auth/login", responses={200: {"model": Token}})
+async def login_user(payload: LoginRequest, background_tasks: BackgroundTasks):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
 
-    user = db["user"].find_one({"email": payload.email.lower()})
-    if not user or not verify_password(payload.password, user.get("password_hash", "")):
+    user = await db["user"].find_one({"email": payload.email}, collation=EMAIL_COLLATION)
+    # bcrypt is deliberately slow; keep it off the event loop
+    password_hash = user.get("password_hash", "") if user else ""
+    if not user or not await run_in_threadpool(verify_password, payload.password, password_hash):
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
+    # Migrate hashes made with an older cost transparently after the response is sent
+    if password_needs_rehash(password_hash):
+        background_tasks.add_task(rehash_password, user["_id"], payload.password)
+
     token = create_access_token({"sub": str(user.get("_id")), "email": user.get("email")})
-    return Token(access_token=token)
+    return ORJSONResponse({"access_token": token, "token_type": "bearer"})
 
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(http_bearer)) -> dict:
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(http_bearer)) -> dict:
     if credentials is None or credentials.scheme.lower() != "bearer":
         raise HTTPException(status_code=401, detail="Not authenticated")
     token = credentials.credentials
+    cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    with _token_cache_lock:
+        cached = _token_cache.get(cache_key)
+    if cached is not None:
+        user, expires_at = cached
+        if time.time() < expires_at:
+            return user
+
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(
+            token, SECRET_KEY, algorithms=[ALGORITHM], options={"require": ["exp", "sub"]}
+        )
         user_id = payload.get("sub")
         if not user_id:
             raise HTTPException(status_code=401, detail="Invalid token payload")
-        user = db["user"].find_one({"_id": ObjectId(user_id)})
+        user = await db["user"].find_one({"_id": ObjectId(user_id)})
         if not user:
             raise HTTPException(status_code=401, detail="User not found")
-        return user
-    except JWTError:
+    except InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+    expires_at = min(float(payload["exp"]), time.time() + TOKEN_CACHE_TTL_SECONDS)
+    with _token_cache_lock:
+        _token_cache[cache_key] = (user, expires_at)
+    return user
+
 
 # === Seed some default shoes if collection empty ===
 @app.post("/seed")
-def seed_shoes():
-    count = db["shoe"].count_documents({}) if db else 0
+async def seed_shoes():
+    count = await db["shoe"].count_documents({}) if db is not None else 0
     if count > 0:
         return {"seeded": False, "message": "Shoes already exist"}
 
+    # Hardcoded, known-good data: model_construct fills schema defaults without validation
     sample = [
-        Shoe(
+        Shoe.model_construct(
             title="Oxford Classic",
             description="Handcrafted leather oxford with cap toe",
             brand="Eleganza",
@@ -187,7 +309,7 @@ def seed_shoes():
             rating=4.7,
             colors=["Black", "Brown"],
         ).model_dump(),
-        Shoe(
+        Shoe.model_construct(
             title="Derby Modern",
             description="Sleek derby with cushioned insole for all‑day comfort",
             brand="UrbanGent",
@@ -199,7 +321,7 @@ def seed_shoes():
             rating=4.6,
             colors=["Tan", "Black"],
         ).model_dump(),
-        Shoe(
+        Shoe.model_construct(
             title="Monk Strap Elite",
             description="Double monk strap in premium full‑grain leather",
             brand="Monarch",
@@ -211,7 +333,7 @@ def seed_shoes():
             rating=4.8,
             colors=["Brown"],
         ).model_dump(),
-        Shoe(
+        Shoe.model_construct(
             title="Wholecut Prestige",
             description="Single‑piece leather wholecut for a seamless silhouette",
             brand="Aristocrat",
@@ -222,7 +344,7 @@ def seed_shoes():
             rating=4.9,
             colors=["Black"],
         ).model_dump(),
-        Shoe(
+        Shoe.model_construct(
             title="Wingtip Heritage",
             description="Classic brogue wingtip with hand‑stitched detailing",
             brand="Heritage",
@@ -236,26 +358,77 @@ def seed_shoes():
     ]
 
     for s in sample:
-        create_document("shoe", s)
+        await create_document("shoe", s)
+    invalidate_shoe_cache()
     return {"seeded": True, "count": len(sample)}
 
 
 # === Product Endpoints ===
+# The catalog rarely changes, so serialized product responses are kept briefly in
+# process memory and served as raw bytes. Call invalidate_shoe_cache() after writes.
+SHOE_CACHE_TTL_SECONDS = 30
+_shoe_list_cache = TTLCache(maxsize=1024, ttl=SHOE_CACHE_TTL_SECONDS)
+_shoe_cache = TTLCache(maxsize=1024, ttl=SHOE_CACHE_TTL_SECONDS)
+
+
+def invalidate_shoe_cache() -> None:
+    _shoe_list_cache.clear()
+    _shoe_cache.clear()
+
+
+def json_bytes_response(body: bytes) -> Response:
+    return Response(content=body, media_type="application/json")
+
+
+# Fields needed to render the product grid. Mongo renames _id to a string id itself,
+# so list documents need no per-document to_public() pass in Python.
+SHOE_LIST_PROJECTION = {
+    "_id": 0,
+    "id": {"$toString": "$_id"},
+    "title": 1,
+    "price": 1,
+    "images": 1,
+    "brand": 1,
+    "rating": 1,
+    "colors": 1,
+    "in_stock": 1,
+}
+
+
 @app.get("/shoes")
-def list_shoes():
-    docs = get_documents("shoe")
-    return [to_public(d) for d in docs]
+async def list_shoes(
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    skip: int = Query(0, ge=0),
+):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    cache_key = (limit, skip)
+    body = _shoe_list_cache.get(cache_key)
+    if body is None:
+        # Paging needs a stable order; _id is unique and indexed
+        pipeline = [{"$sort": {"_id": 1}}, {"$skip": skip}]
+        if limit:
+            pipeline.append({"$limit": limit})
+        pipeline.append({"$project": SHOE_LIST_PROJECTION})
+        body = orjson.dumps(await db["shoe"].aggregate(pipeline).to_list(length=None))
+        _shoe_list_cache[cache_key] = body
+    return json_bytes_response(body)
 
 
 @app.get("/shoes/{shoe_id}")
-def get_shoe(shoe_id: str):
-    try:
-        doc = db["shoe"].find_one({"_id": ObjectId(shoe_id)})
+async def get_shoe(shoe_id: str):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    if not ObjectId.is_valid(shoe_id):
+        raise HTTPException(status_code=400, detail="Invalid ID")
+    body = _shoe_cache.get(shoe_id)
+    if body is None:
+        doc = await db["shoe"].find_one({"_id": ObjectId(shoe_id)})
         if not doc:
             raise HTTPException(status_code=404, detail="Shoe not found")
-        return to_public(doc)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid ID")
+        body = orjson.dumps(to_public(doc))
+        _shoe_cache[shoe_id] = body
+    return json_bytes_response(body)
 
 
 # === Orders (Protected) ===
@@ -274,15 +447,23 @@ class CreateOrderRequest(BaseModel):
 
 
 @app.post("/orders")
-def create_order(payload: CreateOrderRequest, user: dict = Depends(get_current_user)):
+async def create_order(payload: CreateOrderRequest, user: dict = Depends(get_current_user)):
+    # Fetch every product in the cart with a single query
+    if not all(ObjectId.is_valid(item.product_id) for item in payload.items):
+        raise HTTPException(status_code=400, detail="Invalid product id")
+    product_ids = [ObjectId(item.product_id) for item in payload.items]
+    products = {
+        doc["_id"]: doc
+        async for doc in db["shoe"].find(
+            {"_id": {"$in": product_ids}}, projection={"title": 1, "price": 1, "images": 1}
+        )
+    }
+
     # Build order totals from items
     subtotal = 0.0
     order_items = []
-    for item in payload.items:
-        try:
-            doc = db["shoe"].find_one({"_id": ObjectId(item.product_id)})
-        except Exception:
-            raise HTTPException(status_code=400, detail="Invalid product id")
+    for item, product_id in zip(payload.items, product_ids):
+        doc = products.get(product_id)
         if not doc:
             raise HTTPException(status_code=404, detail="Product not found")
         price = float(doc.get("price", 0))
@@ -313,11 +494,23 @@ def create_order(payload: CreateOrderRequest, user: dict = Depends(get_current_u
         "user_id": str(user.get("_id")),
     }
 
-    order_id = create_document("order", order_doc)
-    return {"id": order_id, **order_doc}
+    order_id = await create_document("order", order_doc)
+    return ORJSONResponse({"id": order_id, **order_doc})
 
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    reload = os.getenv("RELOAD", "").lower() in ("1", "true", "yes")
+    # "auto" picks uvloop/httptools (see requirements) and falls back to asyncio/h11 where they
+    # can't be installed. Workers need the import string rather than the app object.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="auto",
+        http="auto",
+        reload=reload,
+        # Each worker has its own Mongo pool (see database.py), so scale this deliberately
+        workers=1 if reload else int(os.getenv("WEB_CONCURRENCY", "2")),
+    )